@@ -1,17 +1,69 @@
 # -*- coding: utf-8 -*-
 
 import os
+import io
+import re
+import html
+import hashlib
 import logging
 import json
 import argparse
+import collections
 import copy
 import webbrowser
-from bs4 import BeautifulSoup as bs
+import lxml.html
+from lxml import etree
+
+## orjson is optional. It serialises much faster than the json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ## HTML Template filepath
 ## New HTML files will be copied from this one.
 HTML_TEMPLATE = 'blockEditorTemplate.html'
 
+## The template doesn't declare a charset, so tell the parser.
+HTML_PARSER = lxml.html.HTMLParser(encoding="utf8")
+
+## GoJS loads the model from this textarea.
+TEXTAREA_MODEL = etree.XPath("//textarea[@id='mySavedModel']")
+
+## The same textarea, for patching the page without parsing it.
+## Groups: opening tag, contents, closing tag.
+TEXTAREA_MODEL_RE = re.compile(rb'(<textarea\b[^>]*\bid=["\']mySavedModel["\'][^>]*>)(.*?)(</textarea>)',re.DOTALL|re.IGNORECASE)
+
+## Characters that go into the page as \uXXXX escapes.
+## The page declares no charset, so it has to stay pure ASCII.
+NON_ASCII_RE = re.compile('[^\x00-\x7f]')
+
+## Patterns for reading Positions.xml without an XML parser (--fast-regex).
+## Groups: the <record> tag's attributes, and everything inside it.
+POSITION_RECORD_RE  = re.compile(rb'<record\b([^>]*)>(.*?)</record>',re.DOTALL)
+POSITION_TYPE_RE    = re.compile(rb'\btype="position"')
+ID_RE               = re.compile(rb'\bid="(\d+)"')
+POSITION_NAME_RE    = re.compile(rb'<name\b[^>]*>(.*?)</name>',re.DOTALL)
+POSITION_DEBATE_RE  = re.compile(rb'<debate\b[^>]*\bid="(\d+)"')
+POSITION_LARGER_RE  = re.compile(rb'<larger_position\b[^>]*\bid="(\d+)"')
+
+## Sidecar file next to the JSON output, holding the fingerprint of the graph it was written from.
+META_SUFFIX = '.meta'
+
+## Sidecar file next to each XML input, holding the table read from it.
+TABLE_SUFFIX = '.table.json'
+
+## Bump this whenever the shape of a read_*() table changes, so old sidecars are ignored.
+TABLE_VERSION = 1
+
+## Parsed HTML pages, keyed by filepath.
+## Each entry is (the bytes last written, the parsed tree they came from).
+HTML_CACHE = {}
+
+## blockEditorTemplate.html, read (and if need be parsed) once per process.
+## Holds 'bytes' and, once the template has been parsed, 'tree'.
+TEMPLATE_CACHE = {}
+
 ## Configure display format
 POSITION_FIGURE = "CreateRequest"
 
@@ -21,6 +73,11 @@ POSITION_FIGURE = "CreateRequest"
 ARGUMENT_OFFSET = 10000
 ARGUMENT_FIGURE = "RoundedRectangle" # default shape for argument nodes
 
+## Link colours.
+## For now, just do green for True, red for everything else.
+LINK_COLOR_DEFAULT = "red"
+LINK_COLOR_BY_VERDICT = {1:"green"}
+
 def run(args):
     """
     The main run method.
@@ -53,14 +110,25 @@ def run(args):
     ## Determine the true JSON filename.
     json_fpath = get_json_filepath(args)
     
-    ## Fix the locations of known nodes and links
-    json_object = fix_locations(json_object,json_fpath)
+    ## If nothing has touched the JSON file since we last wrote it from this same graph,
+    ##  fixing the locations would just write it out again.
+    fingerprint = get_fingerprint(json_object,args['pretty'])
+    json_bytes = read_unchanged_json(json_fpath,fingerprint)
     
-    ## Dump JSON
-    output_json(json_object,json_fpath)
+    if json_bytes is None:
+        
+        ## Fix the locations of known nodes and links
+        json_object = fix_locations(json_object,json_fpath)
+        
+        ## Serialise once; the same text goes to the JSON file and the HTML textarea.
+        json_bytes = dumps_json(json_object,args['pretty'])
+        
+        ## Dump JSON, then record which graph it came from
+        output_json(json_bytes,json_fpath)
+        output_meta(fingerprint,json_fpath)
     
     ## Output HTML
-    output_html(json_object,args['html'])
+    output_html(json_bytes,args['html'],args['safe'])
     
     ## Launch browser
     if args['launch']:launch_html(args['html'])
@@ -69,12 +137,12 @@ def run(args):
 def parse_xml(args):
     """
     Get basic info on nodes and links from XML file.
-
+    
     Parameters
     ----------
     fpath_xml : string
         Filepath location of XML file.
-
+    
     Returns
     -------
     nodes : list
@@ -83,436 +151,575 @@ def parse_xml(args):
     links : list
         GoJS format of links between nodes. Example:
             {"from":25,"to":26}
-
+    
     """
     
     ## DEBATES
-    with open(args['debates'],'r',encoding='utf8') as f:
-        xml_debates = bs(f.read(), features="xml")
+    debates = read_table(read_debates,args['debates'])
     
     ## Sanity check
-    if args['debate'] != 1 and not xml_debates.find("record",id=str(args['debate'])):
+    if args['debate'] != 1 and args['debate'] not in debates:
         logging.error("No debate found! Program will quit.")
         raise ValueError
     
     ## Recursively get all subdebate IDs under this debate
-    debate_ids = get_all_descendant_debates([args['debate']],xml_debates)
+    debate_ids = get_all_descendant_debates([args['debate']],debates)
     
     ## POSITIONS
     ## Load Positions XML
-    with open(args['positions'],'r',encoding="utf8") as f:
-        xml_positions = bs(f.read(), features="xml")
+    if args['fast_regex']:
+        positions = read_table(read_positions_regex,args['positions'])
+    else:
+        positions = read_table(read_positions,args['positions'])
     
     ## Recursively get all position IDs under the listed debates.
-    position_ids = get_all_descendant_positions(debate_ids,xml_positions)
-    
-    ## Extract the nodes 
-    nodes_positions = get_nodes_positions(position_ids,xml_positions)
+    position_ids = get_all_descendant_positions(debate_ids,positions)
     
-    ## Extract the links
-    links_positions = get_links_positions(position_ids,xml_positions)
+    ## Extract the nodes and links
+    nodes_positions,links_positions = get_nodes_links_positions(position_ids,positions)
     
     ## ARGUMENTS
     ## Load Arguments XML
-    with open(args['arguments'],'r',encoding="utf8") as f:
-        xml_arguments = bs(f.read(), features="xml")
+    arguments = read_table(read_arguments,args['arguments'])
     
     ## Recursively get all argument IDs under the listed debates and positions.
-    argument_ids = get_all_descendant_arguments(position_ids,xml_arguments)
-        
-    ## Extract the nodes 
-    nodes_arguments = get_nodes_arguments(argument_ids,xml_arguments)
+    argument_ids = get_all_descendant_arguments(position_ids,arguments)
     
-    ## Extract the links
-    links_arguments = get_links_arguments(position_ids,argument_ids,xml_arguments)
+    ## Extract the nodes and links
+    nodes_arguments,links_arguments = get_nodes_links_arguments(position_ids,argument_ids,arguments)
     
     ## COMBINE
-    nodes = nodes_positions + nodes_arguments
-    links = links_positions + links_arguments
+    ## Extend the position lists in place rather than building a third list each.
+    nodes_positions.extend(nodes_arguments)
+    links_positions.extend(links_arguments)
     
-    return nodes,links
+    return nodes_positions,links_positions
 
-def get_all_descendant_debates(debate_ids,xml_debates):
+def read_table(reader,fpath_xml):
     """
-    Get all descendants of the listed debates.
-
+    Read a table from an XML file with <reader>,
+     or load it from the file's sidecar if the XML hasn't changed since.
+    
+    The sidecar is two lines of JSON: first a signature
+     (TABLE_VERSION, the reader's name, the XML file's modification time and size),
+     then the table as [key,value] pairs, since JSON keys can't be ints.
+    Plain JSON rather than pickle, so a planted sidecar can't run code.
+    
     Parameters
     ----------
-    debate_ids : list
-        Debate IDs to find descendants of.
-    xml_debates : BeautifulSoup object
-        The debates xml file parsed by BeautifulSoup.
+    reader : function
+        One of the read_*() functions, taking the XML filepath.
+    fpath_xml : str
+        Filepath location of XML file.
     
     Returns
     -------
-    debate_ids : list
-        The original IDs together with all their descendants.
-
+    table : dict
+        As returned by <reader>.
+    
     """
     
-    ## Recursively...
-    while True:
-        
-        ## ...find all debates that are children of the current list...
-        def larger_debate_requested(id):
-            if id is not None:
-                return int(id) in debate_ids # filter functions must return True or False
-            
-        ## (From the documentation: "Any argument that’s not recognized 
-        ##   will be turned into a filter on one of a tag’s attributes.")
-        debates_to_add = xml_debates.find_all('larger_debate',id=larger_debate_requested)
-        
-        ## ...add those children to the current list...
-        finished = True
-        for larger_debate_node in debates_to_add:
-            new_debate = int(larger_debate_node.parent["id"])
-            
-            ## (Is this a debate we have not yet collected?)
-            if new_debate not in debate_ids:
-                finished = False
-                debate_ids.append(new_debate)
-        
-        ## ...but quit if no new children were added this time.
-        if finished:break
+    stat = os.stat(fpath_xml)
+    signature = [TABLE_VERSION,reader.__name__,stat.st_mtime_ns,stat.st_size]
+    fpath_table = fpath_xml+TABLE_SUFFIX
+    loads = json.loads if orjson is None else orjson.loads
     
-    ## Sort the list before returning.
-    debate_ids.sort()
+    ## Check the signature line before decoding the (much bigger) table line.
+    ## A missing, stale or broken sidecar just means reading the XML again,
+    ##  so whatever goes wrong here, fall through to that.
+    try:
+        with open(fpath_table,'rb') as f:
+            if loads(f.readline()) == signature:
+                return dict(loads(f.readline()))
+    except Exception:
+        pass
     
-    return debate_ids
+    table = reader(fpath_xml)
+    
+    ## Save it for next time. Failing to is not fatal.
+    ## Compact JSON never contains a raw newline, so each part stays on its own line.
+    try:
+        with open(fpath_table,'wb') as f:
+            f.write(dumps_json(signature)+b'\n')
+            f.write(dumps_json(list(table.items()))+b'\n')
+    except OSError:
+        logging.warning(f"Couldn't write {fpath_table}. The XML will be read again next time.")
+    
+    return table
 
-def get_all_descendant_positions(debate_ids,xml_positions):
+def iter_records(fpath_xml):
     """
-    Some positions have a tag called <debate> and some have <larger_position>.
-    Need to find all of these.
-
+    Stream the <record> elements of a Hypernomicon XML file.
+    Each record is cleared as soon as the caller moves on to the next one,
+     so only pull out what you need while you have it.
+    
     Parameters
     ----------
-    debate_ids : list
-        Debate IDs to find child positions of.
-    xml_positions : BeautifulSoup object
-        E.g. Positions.xml, parsed by BS.
+    fpath_xml : str
+        Filepath location of XML file.
+    
+    Yields
+    ------
+    record : lxml.etree._Element
+        The <record> element, with all of its children.
+    
+    """
+    
+    ## The {*} wildcard matches tags with or without a namespace,
+    ##  in the same way BeautifulSoup did.
+    for _,record in etree.iterparse(fpath_xml,events=("end",),tag="{*}record"):
+        yield record
+        
+        ## Free the record and everything before it, so memory stays bounded.
+        record.clear()
+        while record.getprevious() is not None:
+            del record.getparent()[0]
 
+def read_debates(fpath_xml):
+    """
+    Read the debates XML file.
+    
+    Parameters
+    ----------
+    fpath_xml : str
+        E.g. Debates.xml
+    
     Returns
     -------
-    position_ids : list
-        Position IDs to plot.
+    debates : dict
+        Keyed by debate ID. Each value is the list of larger debate IDs.
+    
+    """
+    
+    ## Only the child -> parent edges are kept.
+    ## iterchildren filters by tag in C, without compiling a path like iterfind does.
+    debates = {}
+    for record in iter_records(fpath_xml):
+        debates[int(record.get('id'))] = [int(larger_debate.get('id')) for larger_debate in record.iterchildren('{*}larger_debate')]
+    
+    return debates
 
+def read_positions(fpath_xml):
     """
+    Read the positions XML file.
     
-    ## Start with the first batch of Positions.
-    def larger_debate_requested(id):
-        if id is not None:
-            return int(id) in debate_ids # filter functions must return True or False
-    
-    positions_to_add = xml_positions.find_all('debate',id=larger_debate_requested)
-    
-    ## Now <positions_to_add> are all the nodes.
-    ## Get the IDs.
-    position_ids = []
-    for position in positions_to_add:
-        ## Avoid duplicates
-        new_position = int(position.parent['id'])
-        if new_position not in position_ids: position_ids.append(new_position)
-    
-    ## Recursively...
-    while True:
-        
-        ## ...find all positions that are children of the current list...
-        def larger_position_requested(id):
-            if id is not None:
-                return int(id) in position_ids # filter functions must return True or False
-            
-        ## (From the documentation: "Any argument that’s not recognized 
-        ##   will be turned into a filter on one of a tag’s attributes.")
-        positions_to_add = xml_positions.find_all('larger_position',id=larger_position_requested)
-        
-        ## ...add those children to the current list...
-        finished = True
-        for larger_position_node in positions_to_add:
-            new_position = int(larger_position_node.parent["id"])
+    Parameters
+    ----------
+    fpath_xml : str
+        E.g. Positions.xml
+    
+    Returns
+    -------
+    positions : dict
+        Keyed by position ID, in document order. Example:
+            {25:{"name":"Interventionism","debates":[1],"larger_positions":[]}}
+    
+    """
+    
+    positions = {}
+    for record in iter_records(fpath_xml):
+        if record.get('type') != "position":continue
+        
+        position = {
+            "name"             : None,
+            "debates"          : [],
+            "larger_positions" : []
+            }
+        
+        ## One pass over the children, rather than one search per tag.
+        ## Strip any namespace from the tag before comparing.
+        for child in record.iterchildren(etree.Element):
+            tag = child.tag.rpartition('}')[2]
             
-            ## (Is this a debate we have not yet collected?)
-            if new_position not in position_ids:
-                finished = False
-                position_ids.append(new_position)
+            if tag == 'name':
+                if position["name"] is None:
+                    position["name"] = child.text or '' # the text inside the <name> tag under the <record> tag
+            elif tag == 'debate':
+                position["debates"].append(int(child.get('id')))
+            elif tag == 'larger_position':
+                position["larger_positions"].append(int(child.get('id')))
         
-        ## ...but quit if no new children were added this time.
-        if finished:break
+        positions[int(record.get('id'))] = position
     
-    ## Sort the list before returning.
-    position_ids.sort()
-    
-    return position_ids
+    return positions
 
-def get_nodes_positions(position_ids,xml_positions):
+def read_positions_regex(fpath_xml):
     """
-    From an XML string, return nodes as GoJS JSON list
-
+    Read the positions XML file with regular expressions, without an XML parser.
+    Gives the same table as read_positions() for files laid out the way Hypernomicon writes them,
+     but doesn't understand CDATA sections or namespace prefixes on tags.
+    
     Parameters
     ----------
-    position_ids : list of ints
-    xml_positions : BeautifulSoup parser object
-
+    fpath_xml : str
+        E.g. Positions.xml
+    
     Returns
     -------
-    nodes : list
-        GoJS format of nodes. Example:
-            {"key":25,"text":"Interventionism"}
+    positions : dict
+        Keyed by position ID, in document order. Example:
+            {25:{"name":"Interventionism","debates":[1],"larger_positions":[]}}
+    
+    """
+    
+    with open(fpath_xml,'rb') as f:
+        xml_bytes = f.read()
+    
+    positions = {}
+    for record in POSITION_RECORD_RE.finditer(xml_bytes):
+        attributes,body = record.groups()
+        if not POSITION_TYPE_RE.search(attributes):continue
+        
+        ## The name is the only text we need, so unescape just that.
+        name = POSITION_NAME_RE.search(body)
+        
+        positions[int(ID_RE.search(attributes).group(1))] = {
+            "name"             : html.unescape(name.group(1).decode("utf8")) if name else None,
+            "debates"          : [int(debate_id) for debate_id in POSITION_DEBATE_RE.findall(body)],
+            "larger_positions" : [int(larger_position_id) for larger_position_id in POSITION_LARGER_RE.findall(body)]
+            }
+    
+    return positions
 
+def read_arguments(fpath_xml):
     """
+    Read the arguments XML file.
+    Only the first <position> and <counterargument> of each argument are kept.
     
-    ## Initialise JSON list of dicts
-    nodes = []
+    Parameters
+    ----------
+    fpath_xml : str
+        E.g. Arguments.xml
     
-    ## Get list of position nodes
-    records_xml = xml_positions.find_all('record',type="position",id=position_ids)
+    Returns
+    -------
+    arguments : dict
+        Keyed by argument ID, in document order. Example:
+            {3:{"name":"Poverty of the Stimulus","position":25,"verdict":1,"counterargument":None}}
     
-    ## Loop and add
-    for record in records_xml:
-        record_dict = {
-            "key"  : int(record['id']), # the id attribute of the <record> tag
-            "text" : record.find('name').text, # the text inside the <name> tag under the <record> tag
-            "figure": POSITION_FIGURE
+    """
+    
+    arguments = {}
+    for record in iter_records(fpath_xml):
+        if record.get('type') != "argument":continue
+        
+        argument = {
+            "name"            : None, # stays None if there is no <name> tag
+            "position"        : None,
+            "verdict"         : None,
+            "counterargument" : None
             }
         
-        ## Add this record to the JSON list
-        nodes.append(record_dict)
+        ## One pass over the children, rather than one search per tag.
+        ## Strip any namespace from the tag before comparing.
+        ## Only the first of each tag counts.
+        for child in record.iterchildren(etree.Element):
+            tag = child.tag.rpartition('}')[2]
+            
+            if tag == 'name':
+                if argument["name"] is None:
+                    argument["name"] = child.text or ''
+            elif tag == 'position':
+                if argument["position"] is None:
+                    argument["position"] = int(child.get('id'))
+                    
+                    ## The verdict is determined by the id attribute of the position_verdict tag.
+                    ## iterchildren filters by tag in C, without compiling a path like find() does.
+                    position_verdict = next(child.iterchildren('{*}position_verdict'),None)
+                    if position_verdict is not None:
+                        argument["verdict"] = int(position_verdict.get('id'))
+            elif tag == 'counterargument':
+                if argument["counterargument"] is None:
+                    argument["counterargument"] = int(child.get('id'))
+        
+        arguments[int(record.get('id'))] = argument
     
-    return nodes
+    return arguments
 
-def get_links_positions(position_ids,xml):
+def get_descendants(ids,children):
+    """
+    Breadth-first search down a parent -> children adjacency.
+    
+    Parameters
+    ----------
+    ids : iterable of ints
+        IDs to find descendants of.
+    children : dict
+        Keyed by parent ID. Each value is the list of child IDs.
+    
+    Returns
+    -------
+    ids : list of ints
+        The original IDs together with all their descendants, sorted.
+    
     """
-    From an XML string, return links as GoJS JSON list
+    
+    seen = set(ids)
+    frontier = list(seen)
+    
+    ## Visit each ID once, a generation at a time.
+    while frontier:
+        next_frontier = []
+        for parent_id in frontier:
+            for child_id in children.get(parent_id,()):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    next_frontier.append(child_id)
+        frontier = next_frontier
+    
+    return sorted(seen)
 
+def get_all_descendant_debates(debate_ids,debates):
+    """
+    Get all descendants of the listed debates.
+    
     Parameters
     ----------
-    position_ids: list of ints
-    xml : BeautifulSoup parser object
+    debate_ids : list
+        Debate IDs to find descendants of.
+    debates : dict
+        The debates xml file, as returned by read_debates().
+    
+    Returns
+    -------
+    debate_ids : list
+        The original IDs together with all their descendants, sorted.
+    
+    """
+    
+    ## Turn the child -> parents table round, once.
+    children = collections.defaultdict(list)
+    for debate_id,larger_debate_ids in debates.items():
+        for larger_debate_id in larger_debate_ids:
+            children[larger_debate_id].append(debate_id)
+    
+    return get_descendants(debate_ids,children)
 
+def get_all_descendant_positions(debate_ids,positions):
+    """
+    Some positions have a tag called <debate> and some have <larger_position>.
+    Need to find all of these.
+    
+    Parameters
+    ----------
+    debate_ids : list
+        Debate IDs to find child positions of.
+    positions : dict
+        E.g. Positions.xml, as returned by read_positions().
+    
     Returns
     -------
+    position_ids : list
+        Position IDs to plot, sorted.
+    
+    """
+    
+    ## Start with the first batch of Positions.
+    ## (Hashed membership tests, and no duplicates.)
+    debate_ids = set(debate_ids)
+    position_ids = {position_id for position_id,position in positions.items()
+                                if not debate_ids.isdisjoint(position["debates"])}
+    
+    ## Turn the child -> parents table round, once.
+    children = collections.defaultdict(list)
+    for position_id,position in positions.items():
+        for larger_position_id in position["larger_positions"]:
+            children[larger_position_id].append(position_id)
+    
+    return get_descendants(position_ids,children)
+
+def get_nodes_links_positions(position_ids,positions):
+    """
+    From the positions table, return nodes and links as GoJS JSON lists.
+    Both come out of the same pass over the positions.
+    
+    Parameters
+    ----------
+    position_ids : set of ints
+    positions : dict
+        As returned by read_positions().
+    
+    Returns
+    -------
+    nodes : list
+        GoJS format of nodes. Example:
+            {"key":25,"text":"Interventionism"}
     links : list
         GoJS format of links between nodes. Example:
             {"from":25,"to":26}
-
-    """
     
-    ## We have already figured out exactly which positions we need.
-    def position_has_parent(tag):
-        return tag.name=='record' and tag.find('larger_position')  is not None\
-                                  and int(tag.find('larger_position')['id']) in position_ids
+    """
     
-    ## Get all records with parents
-    records_xml = xml.find_all(position_has_parent)
+    ## Hashed membership tests from here on
+    position_ids = frozenset(position_ids)
     
-    ## Initialise
+    ## Initialise JSON lists of dicts
+    nodes = []
     links = []
     
-    for child_record in records_xml:
+    ## Loop and add.
+    ## A position whose larger position is requested was itself requested,
+    ##  so the others can't contribute links either.
+    for position_id,position in positions.items():
+        if position_id not in position_ids:continue
+        
+        record_dict = {
+            "key"  : position_id, # the id attribute of the <record> tag
+            "text" : position["name"], # the text inside the <name> tag under the <record> tag
+            "figure": POSITION_FIGURE
+            }
+        
+        ## Add this record to the JSON list
+        nodes.append(record_dict)
+        
+        ## We have already figured out exactly which positions we need.
+        ## Only the first <larger_position> is drawn.
+        if not position["larger_positions"]:continue
+        larger_position_id = position["larger_positions"][0]
+        if larger_position_id not in position_ids:continue
         
         ## Create arrow dict object
         arrow_dict = {
-            "from": int(child_record.find('larger_position')['id']),
-            "to"  : int(child_record['id'])
+            "from": larger_position_id,
+            "to"  : position_id
             }
         
         ## Append arrow to dict
         links.append(arrow_dict)
     
-    return links
+    return nodes,links
 
-def get_all_descendant_arguments(position_ids,xml_arguments):
+def get_all_descendant_arguments(position_ids,arguments):
     """
     Filter by arguments relative to the selected positions
-
+    
     Parameters
     ----------
-    position_ids : list of ints
-        DESCRIPTION.
-    xml_arguments : Beautiful soup object
-        DESCRIPTION.
-
+    position_ids : set of ints
+        Position IDs to find child arguments of.
+    arguments : dict
+        As returned by read_arguments().
+    
     Returns
     -------
     argument_ids : list of ints
-        DESCRIPTION.
-
+        Argument IDs to plot, sorted.
+    
     """
     
     ## Some arguments don't have positions as parents, just other arguments.
     ## Need to get all children of positions,
     ##  as well as all children of arguments.
-    def argument_has_parent_position(tag):
-        return tag.name=='record' and tag.find('position')  is not None\
-                                  and int(tag.find('position')['id']) in position_ids
-    
-    arguments = xml_arguments.find_all(argument_has_parent_position)
-    
-    ## Extract the IDs from the nodes
-    argument_ids = []
-    for argument in arguments:
-        argument_ids.append(int(argument["id"]))
-        
-    ## Now recursively find all counterarguments,
-    ##  and add them if they aren't already in argument_ids = [].
-    ## Recursively...
-    while True:
-        
-        ## ...find arguments that point to known arguments...
-        def argument_has_parent_argument(tag):
-            return tag.name=='record' and tag.find('counterargument') is not None\
-                                      and int(tag.find('counterargument')["id"]) in argument_ids
+    ## Collect both in one pass over the arguments.
+    ## (Hashed membership tests, and no duplicates.)
+    position_ids = frozenset(position_ids)
+    argument_ids = set()
+    children = collections.defaultdict(list)
+    for argument_id,argument in arguments.items():
         
-        ## Get all records with parent arguments
-        arguments_with_parent_arguments_xml = xml_arguments.find_all(argument_has_parent_argument)
-        
-        ## Add it if it's not already in there
-        finished = True
-        for argument in arguments_with_parent_arguments_xml:
-            
-            ## Convert from string to int
-            argument_id_new = int(argument["id"])
-            
-            ## Is it not already in our list?
-            if argument_id_new not in argument_ids:
-                
-                ## Don't break, because this newly-added argument
-                ##  might have counterarguments that haven't yet been added
-                finished = False 
-                
-                ## Add the new argument
-                argument_ids.append(argument_id_new)
+        ## Children of the requested positions
+        if argument["position"] in position_ids:
+            argument_ids.add(argument_id)
         
-        if finished==True:break
-    
+        ## The argument -> counterargument table, turned round
+        if argument["counterargument"] is not None:
+            children[argument["counterargument"]].append(argument_id)
     
-    return argument_ids
+    ## Now find all counterarguments, and their counterarguments, and so on.
+    return get_descendants(argument_ids,children)
 
-def get_nodes_arguments(argument_ids,xml_arguments):
+def get_nodes_links_arguments(position_ids,argument_ids,arguments):
     """
-    From an XML string, return nodes as GoJS JSON list.
+    From the arguments table, return nodes and links as GoJS JSON lists.
+    Both come out of the same pass over the arguments.
     IDs for arguments are offset by 10,000 to prevent conflict with position IDs.
     This will break if you have more than <ARGUMENT_OFFSET> positions!
-
+    
     Parameters
     ----------
-    argument_ids: list of ints
-    xml_arguments : BeautifulSoup parser object
-
+    positions_ids : set of ints
+    argument_ids  : set of ints
+    arguments : dict
+        As returned by read_arguments().
+    
     Returns
     -------
     nodes : list
         GoJS format of nodes. Example:
             {"key":10001,"text":"Poverty of the Stimulus (Pullum &amp; Scholz 2002)"}
-
-    """
-    
-    ## Initialise JSON list of dicts
-    nodes = []
-    
-    ## Just positions for now
-    ## Later we will include arguments.
-    records_xml = xml_arguments.find_all('record',type="argument",id=argument_ids)
-    
-    ## Loop and add
-    for record in records_xml:
-        if record.find('name'):
-            record_dict = {
-                "key"  : int(record['id'])+ARGUMENT_OFFSET, # the id attribute of the <record> tag
-                "text" : record.find('name').text, # the text inside the <name> tag under the <record> tag
-                "figure" : ARGUMENT_FIGURE
-                }
-            
-            ## Add this record to the JSON list
-            nodes.append(record_dict)
-    
-    return nodes
-
-def get_links_arguments(position_ids,argument_ids,xml_arguments):
-    """
-    From an XML string, return links as GoJS JSON list.
-    Offset argument IDs by <ARGUMENT OFFSET>
-
-    Parameters
-    ----------
-    positions_ids : list of ints
-    argument_ids  : list of ints
-    xml_arguments : BeautifulSoup parser object
-
-    Returns
-    -------
     links : list
         GoJS format of links between nodes. Example:
             {"from":25,"to":26}
-
-    """
-    
-    ## 1. Get two lists: arguments that point to positions, and
-    ##     arguments that link to other arguments.
-    ##    An argument may appear in both lists.
-    
-    ## Define complex search function for BeautifulSoup
-    ## Find arguments that point to positions
-    def argument_has_parent_position(tag):
-        return tag.name=='record' and tag.find('position')  is not None\
-                                  and int(tag.find('position')['id']) in position_ids
     
-    ## Get all records with parent positions
-    arguments_with_parent_positions_xml = xml_arguments.find_all(argument_has_parent_position)
-    
-    ## Find arguments that point to other arguments
-    def argument_has_parent_argument(tag):
-        return tag.name=='record' and tag.find('counterargument') is not None\
-                                  and int(tag.find('counterargument')["id"]) in argument_ids
+    """
     
-    ## Get all records with parent arguments
-    arguments_with_parent_arguments_xml = xml_arguments.find_all(argument_has_parent_argument)
+    ## Hashed membership tests from here on
+    position_ids = frozenset(position_ids)
+    argument_ids = frozenset(argument_ids)
     
-    ## 2. Build the links list.
-    ## Initialise
+    ## Initialise JSON lists of dicts
+    nodes = []
     links = []
     
-    ## First link arguments to positions
-    for record in arguments_with_parent_positions_xml:
-        
-        ## Create arrow dict object.
-        ## Here the arrow goes from the position to the argument.
-        ## It might be preferable to do it the other way round.
-        arrow_dict = {
-            "from": int(record.find('position')['id']),
-            "to"  : int(record['id'])+ARGUMENT_OFFSET
-            }
-        
-        ## Determine arrow color
-        ## The verdict is determined by the id attribute of the position_verdict tag
-        verdict = int(record.find('position').find('position_verdict')['id'])
+    ## One pass over the arguments.
+    ## An argument that points to a requested position or argument was itself requested,
+    ##  so the others can't contribute links either.
+    for argument_id,argument in arguments.items():
+        if argument_id not in argument_ids:continue
         
-        ## For now, just do green for True, red for everything else
-        if verdict == 1:
-            arrow_dict["color"] = "green"
-        else:
-            arrow_dict["color"] = "red"
+        ## Look everything up once
+        key = argument_id+ARGUMENT_OFFSET
+        name = argument["name"]
+        position_id = argument["position"]
+        counterargument_id = argument["counterargument"]
         
-        ## Append arrow to dict
-        links.append(arrow_dict)
-    
-    ## Now link arguments to other arguments
-    for record in arguments_with_parent_arguments_xml:
-        
-        ## Create arrow dict object.
-        ## Here the arrow goes from the original argument to the counterargument.
-        ## It might be preferable to do it the other way round.
-        arrow_dict = {
-            "from": int(record.find('counterargument')['id'])+ARGUMENT_OFFSET,
-            "to"  : int(record['id'])+ARGUMENT_OFFSET
-            }
+        ## Arguments without a name don't get a node
+        if name is not None:
+            record_dict = {
+                "key"  : key, # the id attribute of the <record> tag
+                "text" : name, # the text inside the <name> tag under the <record> tag
+                "figure" : ARGUMENT_FIGURE
+                }
+            
+            ## Add this record to the JSON list
+            nodes.append(record_dict)
         
-        ## Color: assume all counterarguments are red
-        arrow_dict["color"] = "red"
+        ## Each argument may point to a position, to another argument, or both,
+        ##  so it gives rise to zero, one or two links.
+        ## First link arguments to positions
+        if position_id in position_ids:
+            
+            ## Create arrow dict object.
+            ## Here the arrow goes from the position to the argument.
+            ## It might be preferable to do it the other way round.
+            arrow_dict = {
+                "from": position_id,
+                "to"  : key
+                }
+            
+            ## Determine arrow color
+            arrow_dict["color"] = LINK_COLOR_BY_VERDICT.get(argument["verdict"],LINK_COLOR_DEFAULT)
+            
+            ## Append arrow to dict
+            links.append(arrow_dict)
         
-        links.append(arrow_dict)
+        ## Now link arguments to other arguments
+        if counterargument_id in argument_ids:
+            
+            ## Create arrow dict object.
+            ## Here the arrow goes from the original argument to the counterargument.
+            ## It might be preferable to do it the other way round.
+            arrow_dict = {
+                "from": counterargument_id+ARGUMENT_OFFSET,
+                "to"  : key
+                }
+            
+            ## Color: assume all counterarguments are red
+            arrow_dict["color"] = LINK_COLOR_DEFAULT
+            
+            links.append(arrow_dict)
     
-    return links
+    return nodes,links
 
 def create_json(nodes,links):
     """
@@ -540,6 +747,37 @@ def create_json(nodes,links):
     
     return json_object
 
+def dumps_json(json_object,pretty=False):
+    """
+    Serialise the JSON object.
+    Uses orjson if it's installed, otherwise the json module.
+    Both give the same text.
+
+    Parameters
+    ----------
+    json_object : dict
+        As returned by create_json().
+    pretty : bool, optional
+        Indent the output for human readers. The default is False.
+        GoJS doesn't need it, and it roughly doubles the size.
+
+    Returns
+    -------
+    json_bytes : bytes
+        The serialised JSON object, UTF-8 encoded.
+
+    """
+    
+    ## orjson builds the whole payload in C in one go, already encoded.
+    ## It only knows how to indent by two spaces.
+    if orjson is not None:
+        return orjson.dumps(json_object,option=orjson.OPT_INDENT_2 if pretty else 0)
+    
+    if pretty:
+        return json.dumps(json_object,indent=2,ensure_ascii=False).encode("utf8")
+    
+    return json.dumps(json_object,separators=(",",":"),ensure_ascii=False).encode("utf8")
+
 def get_json_filepath(args):
     """
     Determine the JSON filepath.
@@ -557,17 +795,100 @@ def get_json_filepath(args):
 
     """
     
-    fpath_raw = args["json"]
-    debate_id_str = str(args["debate"])
-    
     ## If it already ends with .json, chop that off before adding the debate ID
-    if len(fpath_raw) > 5 and fpath_raw[-5:] == '.json':
-        fpath_raw = fpath_raw[:-5]
+    fpath_raw = args["json"].removesuffix('.json')
     
-    json_fpath = f'{fpath_raw}_{debate_id_str}.json'
+    json_fpath = f'{fpath_raw}_{args["debate"]}.json'
     
     return json_fpath
 
+def get_fingerprint(json_object,pretty=False):
+    """
+    Summarise the graph built from the XML, and how it is written out,
+     so we can tell whether it has changed since the last run.
+
+    Parameters
+    ----------
+    json_object : dict
+        As returned by create_json(), before fix_locations().
+    pretty : bool, optional
+        As passed to dumps_json(). The default is False.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest of the nodes, links and format.
+
+    """
+    
+    ## repr is deterministic for lists of dicts of ints and strings.
+    graph = repr((json_object['nodeDataArray'],json_object['linkDataArray'],pretty))
+    
+    return hashlib.sha1(graph.encode("utf8")).hexdigest()
+
+def read_unchanged_json(fpath_json,fingerprint):
+    """
+    Get the JSON file as it stands, if it was written from this same graph
+     and hasn't been modified since.
+    In that case fix_locations() would give back exactly what's in the file.
+
+    Parameters
+    ----------
+    fpath_json : str
+        The JSON filepath.
+    fingerprint : str
+        As returned by get_fingerprint().
+
+    Returns
+    -------
+    json_bytes : bytes or None
+        The contents of the JSON file, or None if it needs regenerating.
+
+    """
+    
+    fpath_meta = fpath_json + META_SUFFIX
+    
+    try:
+        with open(fpath_meta,'r',encoding="utf8") as f:
+            fingerprint_previous = f.read()
+        
+        ## The meta file is written straight after the JSON file,
+        ##  so if the JSON file is newer, someone else has saved over it.
+        if fingerprint_previous != fingerprint\
+            or os.stat(fpath_json).st_mtime_ns > os.stat(fpath_meta).st_mtime_ns:
+            return None
+        
+        with open(fpath_json,'rb') as f:
+            return f.read()
+        
+    except FileNotFoundError:
+        return None
+
+def load_json(fpath_json):
+    """
+    Load a JSON file.
+
+    Parameters
+    ----------
+    fpath_json : str
+        The JSON filepath.
+
+    Returns
+    -------
+    json_object : dict
+        The decoded JSON file.
+
+    """
+    
+    ## Both decoders take the UTF-8 bytes directly.
+    with open(fpath_json,'rb') as f:
+        json_bytes = f.read()
+    
+    if orjson is not None:
+        return orjson.loads(json_bytes)
+    
+    return json.loads(json_bytes)
+
 def fix_locations(json_object,fpath_json):
     """
     Nodes and links.
@@ -590,22 +911,34 @@ def fix_locations(json_object,fpath_json):
     ## First add the filename to the json object
     json_object['filename'] = fpath_json
     
-    ## Get the current HTML file
+    ## Get the current JSON file
     try:
-        with open(fpath_json,'r',encoding="utf8") as f:
-            json_object_current = json.loads(f.read()) 
+        json_object_current = load_json(fpath_json)
     except FileNotFoundError:
         ## The file doesn't exist yet, so no need to specify existing properties.
         ## The file will be created with default properties.
         return json_object
     
+    ## A run on an unrelated debate shares nothing with the current file.
+    ## Spot that before indexing it: isdisjoint() stops at the first shared key.
+    node_keys = {node["key"] for node in json_object['nodeDataArray']}
+    link_keys = {(link["from"],link["to"]) for link in json_object['linkDataArray']}
+    if node_keys.isdisjoint(node_current["key"] for node_current in json_object_current['nodeDataArray']) \
+        and link_keys.isdisjoint((link_current["from"],link_current["to"]) for link_current in json_object_current['linkDataArray']):
+        return json_object
+    
+    ## Index the current nodes by key and the current links by (from, to).
+    ## Build them back to front, so that the first of any duplicates wins.
+    nodes_current = {node_current["key"]:node_current for node_current in reversed(json_object_current['nodeDataArray'])}
+    links_current = {(link_current["from"],link_current["to"]):link_current for link_current in reversed(json_object_current['linkDataArray'])}
+    
     ## Now for each of the nodes we want to add, check whether it already exists in <json_object_current>.
     ## If so, keep its location.
     ## Same with links.
     for node in json_object['nodeDataArray']:
         
         ## Does this node already exist?
-        node_current = find_node(json_object_current,node)
+        node_current = nodes_current.get(node["key"])
         
         if not node_current:continue
         
@@ -622,7 +955,7 @@ def fix_locations(json_object,fpath_json):
     for link in json_object['linkDataArray']:
         
         ## Does this link already exist?
-        link_current = find_link(json_object_current,link)
+        link_current = links_current.get((link["from"],link["to"]))
         
         if not link_current:continue
         
@@ -633,85 +966,132 @@ def fix_locations(json_object,fpath_json):
     
     return json_object
 
-def find_node(json_object_current,node)->None:
+def output_json(json_bytes,fpath_out):
     """
-    Determine whether a node with this ID already exists
+    Dump JSON to specified file.
 
     Parameters
     ----------
-    json_object_current : dict
-        DESCRIPTION.
-    node : dict
-        DESCRIPTION.
+    json_bytes : bytes
+        The serialised JSON object, as returned by dumps_json().
+    fpath_out : str
+        Filepath to output the JSON file.
 
     Returns
     -------
-    node_current : dict
-        DESCRIPTION.
+    None.
 
     """
     
-    for node_current_candidate in json_object_current['nodeDataArray']: # maybe there's a quicker way to do this
-        if node_current_candidate["key"] == node["key"]: return node_current_candidate
+    ## One write call rather than one per token, and no re-encoding.
+    with open(fpath_out,'wb') as f:
+        f.write(json_bytes)
+    
+def output_meta(fingerprint,fpath_json):
+    """
+    Record which graph the JSON file was written from.
+    Must be called after the JSON file is written.
+
+    Parameters
+    ----------
+    fingerprint : str
+        As returned by get_fingerprint().
+    fpath_json : str
+        The JSON filepath.
+
+    Returns
+    -------
+    None.
 
-def find_link(json_object_current,link)->None:
     """
-    Determine whether a link with this from- and to- already exists.
+    
+    with open(fpath_json + META_SUFFIX,'w',encoding="utf8") as f:
+        f.write(fingerprint)
+    
+def read_template(parse=False):
+    """
+    Get blockEditorTemplate.html, reading it only on the first call.
 
     Parameters
     ----------
-    json_object_current : TYPE
-        DESCRIPTION.
-    link : TYPE
-        DESCRIPTION.
+    parse : bool, optional
+        Also return the parsed template. The default is False.
 
     Returns
     -------
-    link_current : TYPE
-        DESCRIPTION.
+    html_bytes : bytes
+        The raw template.
+    tree : lxml.etree._ElementTree or None
+        The parsed template, if <parse> was set.
+        This is shared between calls, so copy it before changing it.
 
     """
     
-    for link_current_candidate in json_object_current['linkDataArray']: # maybe there's a quicker way to do this
-        if link_current_candidate["from"] == link["from"] and link_current_candidate["to"] == link["to"]: 
-            return link_current_candidate
+    if 'bytes' not in TEMPLATE_CACHE:
+        with open(HTML_TEMPLATE,'rb') as f:
+            TEMPLATE_CACHE['bytes'] = f.read()
+    
+    if parse and 'tree' not in TEMPLATE_CACHE:
+        TEMPLATE_CACHE['tree'] = lxml.html.parse(io.BytesIO(TEMPLATE_CACHE['bytes']),parser=HTML_PARSER)
+    
+    return TEMPLATE_CACHE['bytes'],TEMPLATE_CACHE.get('tree')
 
-def output_json(json_object,fpath_out):
+def escape_non_ascii(json_bytes):
     """
-    Dump JSON to specified file.
+    Escape non-ASCII characters in serialised JSON as \\uXXXX,
+     as json.dumps() does by default.
+    orjson can't be told to do this itself.
+    
+    These characters only ever occur inside JSON strings,
+     so escaping them leaves the same JSON.
 
     Parameters
     ----------
-    json_object : TYPE
-        DESCRIPTION.
-    fpath_out : TYPE
-        DESCRIPTION.
+    json_bytes : bytes
+        The serialised JSON object, UTF-8 encoded.
 
     Returns
     -------
-    None.
+    json_bytes : bytes
+        The same JSON, pure ASCII.
 
     """
     
-    with open(fpath_out,'w',encoding="utf8") as f:
-        json.dump(
-            json_object,
-            f,
-            indent=4 # pretty print
-            )
+    if json_bytes.isascii():
+        return json_bytes
     
-def output_html(json_object,fpath_html):
+    def escape(match):
+        code = ord(match.group())
+        if code < 0x10000:
+            return '\\u%04x' % code
+        
+        ## Outside the BMP: a UTF-16 surrogate pair
+        code -= 0x10000
+        return '\\u%04x\\u%04x' % (0xd800|(code>>10),0xdc00|(code&0x3ff))
+    
+    return NON_ASCII_RE.sub(escape,json_bytes.decode("utf8")).encode("ascii")
+
+def output_html(json_bytes,fpath_html,safe=False):
     """
     Basically assumes a blockEditor type page
      where the JSON can be dumped into a textarea.
      
     If <fpath_html> doesn't exist, it will be created
      from blockEditorTemplate.html
+    
+    By default the textarea contents are swapped out with a regex,
+     without parsing the rest of the page.
+    If <safe> is set, or the regex can't find the textarea,
+     the page is parsed with lxml instead.
 
     Parameters
     ----------
+    json_bytes : bytes
+        The serialised JSON object, as returned by dumps_json().
     fpath_html : str
         Filepath to output the HTML file.
+    safe : bool, optional
+        Always parse the page. The default is False.
 
     Returns
     -------
@@ -719,26 +1099,56 @@ def output_html(json_object,fpath_html):
 
     """
     
+    ## Keep the page ASCII, whatever the JSON file holds.
+    json_bytes = escape_non_ascii(json_bytes)
+    
     ## Does the html file exist yet?
+    template_tree = None
     try:
-        with open(fpath_html,'r',encoding="utf8") as f:
-            html = bs(f.read(), features="lxml")
+        with open(fpath_html,'rb') as f:
+            html_bytes = f.read()
     except FileNotFoundError:
         ## The html file doesn't exist.
         ## Create it from blockEditorTemplate.html
-        with open(HTML_TEMPLATE,'r',encoding="utf8") as f:
-            html = bs(f.read(), features="lxml")
+        html_bytes,template_tree = read_template(parse=safe)
     
-    def textarea_model(tag):
-        return tag.name=='textarea' and tag['id']=='mySavedModel'
+    ## Fast path: patch the textarea in place, all in UTF-8 bytes.
+    if not safe:
+        
+        ## Escape the text the same way lxml does (cf. html.escape(quote=False)).
+        textarea_contents = json_bytes.replace(b'&',b'&amp;').replace(b'<',b'&lt;').replace(b'>',b'&gt;')
+        html_patched,found = TEXTAREA_MODEL_RE.subn(lambda match: match.group(1)+textarea_contents+match.group(3),
+                                                    html_bytes,
+                                                    count=1)
+        
+        if found:
+            ## Dump HTML
+            with open(fpath_html,'wb') as f:
+                f.write(html_patched)
+            return
+        
+        logging.warning("Couldn't find the model textarea with a regex. Parsing the page instead.")
+    
+    ## Parse the page, unless it's the template or exactly what we wrote last time.
+    ## The cached template is copied so it stays pristine for the next new page.
+    if template_tree is not None:
+        tree = copy.deepcopy(template_tree)
+    elif fpath_html in HTML_CACHE and HTML_CACHE[fpath_html][0] == html_bytes:
+        tree = HTML_CACHE[fpath_html][1]
+    else:
+        tree = lxml.html.parse(io.BytesIO(html_bytes),parser=HTML_PARSER)
     
-    textarea = html.find(textarea_model)
+    textarea = TEXTAREA_MODEL(tree)[0]
     
-    textarea.string = json.dumps(json_object,indent=4)
+    textarea.text = json_bytes.decode("utf8")
     
     ## Dump HTML
-    with open(fpath_html,'w',encoding="utf8") as f:
-        f.write(str(html))
+    html_bytes = etree.tostring(tree,method="html",encoding="utf8")
+    with open(fpath_html,'wb') as f:
+        f.write(html_bytes)
+    
+    ## Remember the page as written, so the next run can skip parsing it.
+    HTML_CACHE[fpath_html] = (html_bytes,tree)
 
 def launch_html(fpath_html):
     """
@@ -825,6 +1235,21 @@ parser.add_argument('--launch',
                     default=True
                     )
 
+## Should the JSON be indented for humans to read?
+parser.add_argument('--pretty',
+                    action='store_true' # off unless given
+                    )
+
+## Should we parse the HTML file rather than patching it with a regex?
+parser.add_argument('--safe',
+                    action='store_true' # off unless given
+                    )
+
+## Should we read Positions.xml with regular expressions rather than an XML parser?
+parser.add_argument('--fast-regex',
+                    action='store_true' # off unless given
+                    )
+
 '''
     Main conditional block
 '''